@@ -7,15 +7,31 @@
 2. 自动创建 _photos collection 文件，包含日期、地点、tag等信息
 """
 
+import io
 import os
+import re
 import sys
+import tempfile
+import functools
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime
-from PIL import Image
-from PIL.ExifTags import TAGS, GPSTAGS
+from PIL import Image, features
+from PIL.ExifTags import Base, IFD, GPSTAGS
 import json
 import yaml
 
+# 我们不使用 MPO 的多帧（立体/深度图），直接用 JpegImageFile 打开 JPEG，
+# 跳过 jpeg_factory 中的 MPO 头解析和逐帧偏移扫描；
+# 新版 Pillow 若调整了插件结构则保持默认行为
+try:
+    from PIL import JpegImagePlugin
+    Image.register_open(JpegImagePlugin.JpegImageFile.format,
+                        JpegImagePlugin.JpegImageFile, JpegImagePlugin._accept)
+except (ImportError, AttributeError):
+    pass
+
 # 项目根目录
 PROJECT_ROOT = Path(__file__).parent.parent
 PHOTOS_DIR = PROJECT_ROOT / "assets" / "images" / "photos"
@@ -24,55 +40,98 @@ COLLECTION_DIR = PROJECT_ROOT / "_photos"
 TEMP_DIR = PROJECT_ROOT / "assets" / "images" / "photos" / "_temp"  # 临时存放新图片的目录
 PHOTOS_DATA_FILE = PROJECT_ROOT / "_data" / "photos.yml"  # 照片信息记录文件
 
+# 解析后的项目根目录只计算一次，避免每张图片都调用 realpath
+_PROJECT_ROOT_RESOLVED = PROJECT_ROOT.resolve()
+# 缩略图目录在本进程中是否已创建
+_THUMB_DIR_READY = False
+
 THUMB_MAX_WIDTH = 720
-THUMB_QUALITY = 82
+THUMB_QUALITY = 80
+THUMB_WEBP_METHOD = 4  # libwebp 压缩档位（0-6），4 在速度和体积之间较均衡
+
+# 支持的图片格式（小写，匹配时忽略大小写）
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+
+# 已重命名照片的文件名格式：YYMMDD_ID.jpg / .jpeg
+_PHOTO_FILENAME_RE = re.compile(r'^(\d{6})_(\d+)\.jpe?g$', re.IGNORECASE)
 
 
 def path_to_site_url(file_path: Path) -> str:
     """将项目内的文件转换为站点可引用的URL"""
     try:
-        rel_path = file_path.resolve().relative_to(PROJECT_ROOT.resolve())
+        rel_path = file_path.resolve().relative_to(_PROJECT_ROOT_RESOLVED)
     except ValueError as exc:
         raise ValueError(f"图片必须位于项目目录内: {file_path}") from exc
     return "/" + rel_path.as_posix()
 
 
-def get_exif_data(image_path):
-    """读取图片的EXIF数据"""
+def scan_image_entries(directory):
+    """单次扫描目录，返回其中图片文件的 DirEntry 列表"""
+    with os.scandir(directory) as entries:
+        return [entry for entry in entries
+                if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS]
+
+
+@contextmanager
+def open_image(image_path):
+    """打开图片；在Linux上提示内核按顺序预读，用完后释放该文件的页缓存"""
+    fadvise = getattr(os, 'posix_fadvise', None)
+    with open(image_path, 'rb') as fp:
+        if fadvise:
+            fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        try:
+            with Image.open(fp) as img:
+                yield img
+        finally:
+            # 原图处理完后本次运行不会再读取，避免其挤占页缓存
+            if fadvise:
+                fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def get_exif_data(img):
+    """读取已打开图片的EXIF数据（只解析文件头，不解码像素）"""
     try:
-        image = Image.open(image_path)
-        exif_data = image._getexif()
-        
-        if exif_data is None:
-            return None
-        
-        exif = {}
-        for tag_id, value in exif_data.items():
-            tag = TAGS.get(tag_id, tag_id)
-            exif[tag] = value
-        
-        return exif
+        return img.getexif()
     except Exception as e:
-        print(f"读取EXIF数据失败 {image_path}: {e}")
+        print(f"读取EXIF数据失败: {e}")
         return None
 
 
+@functools.lru_cache(maxsize=4096)
+def _parse_exif_date(date_str):
+    """解析EXIF日期字符串；连拍等同一时间的照片会直接命中缓存"""
+    try:
+        # 固定格式直接按位置切片，比 strptime 快得多
+        return datetime(
+            int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]),
+            int(date_str[11:13]), int(date_str[14:16]), int(date_str[17:19]),
+        )
+    except ValueError:
+        # 格式不规范时交给 strptime 处理
+        return datetime.strptime(date_str, "%Y:%m:%d %H:%M:%S")
+
+
 def get_date_from_exif(exif_data):
     """从EXIF数据中提取拍摄日期"""
     if not exif_data:
         return None
     
-    # 尝试多个可能的日期字段
-    date_fields = ['DateTimeOriginal', 'DateTimeDigitized', 'DateTime']
+    # 按标签ID直接查找，避免遍历全部IFD条目
+    # DateTimeOriginal/DateTimeDigitized 位于 Exif 子IFD，DateTime 位于 IFD0
+    exif_ifd = exif_data.get_ifd(IFD.Exif)
+    date_fields = [
+        (exif_ifd, Base.DateTimeOriginal),
+        (exif_ifd, Base.DateTimeDigitized),
+        (exif_data, Base.DateTime),
+    ]
     
-    for field in date_fields:
-        if field in exif_data:
+    for ifd, field in date_fields:
+        if field in ifd:
             try:
-                date_str = exif_data[field]
+                date_str = ifd[field]
                 # EXIF日期格式通常是 "YYYY:MM:DD HH:MM:SS"
                 if isinstance(date_str, str):
-                    date_obj = datetime.strptime(date_str, "%Y:%m:%d %H:%M:%S")
-                    return date_obj
+                    return _parse_exif_date(date_str)
             except Exception as e:
                 print(f"解析日期失败 {field}: {e}")
                 continue
@@ -92,64 +151,99 @@ def format_date_for_frontmatter(date_obj):
 
 def generate_photo_id(date_str, existing_files):
     """生成照片ID（同一日期的照片编号）"""
-    # 查找同一天的照片数量
-    same_date_files = [f for f in existing_files if f.startswith(date_str)]
-    
-    if not same_date_files:
-        return 1
-    
-    # 提取已有的ID
+    # 提取同一天已有照片的ID，格式：日期_ID.jpg
     ids = []
-    for f in same_date_files:
-        try:
-            # 格式：日期_ID.jpg
-            parts = f.replace('.jpg', '').replace('.JPG', '').split('_')
-            if len(parts) == 2:
-                ids.append(int(parts[1]))
-        except:
-            continue
+    for f in existing_files:
+        match = _PHOTO_FILENAME_RE.match(f)
+        if match and match.group(1) == date_str:
+            ids.append(int(match.group(2)))
     
-    if ids:
-        return max(ids) + 1
-    else:
-        return 1
+    return max(ids, default=0) + 1
 
 
 
-def create_thumbnail(image_path, max_width=THUMB_MAX_WIDTH, quality=THUMB_QUALITY):
-    """为列表页生成小尺寸缩略图"""
-    if not image_path.exists():
-        return None
+def thumbnail_path_for(rel_path):
+    """根据原图相对项目根目录的路径得到缩略图路径"""
+    safe_name = "_".join(rel_path.with_suffix('').parts) + "_thumb.webp"
+    return THUMB_DIR / safe_name
 
-    THUMB_DIR.mkdir(parents=True, exist_ok=True)
 
+def get_thumbnail_path(image_path):
+    """根据原图在项目内的相对路径得到缩略图路径，图片不在项目内时返回None"""
     try:
-        rel_path = image_path.resolve().relative_to(PROJECT_ROOT.resolve())
-    except ValueError as exc:
+        rel_path = image_path.resolve().relative_to(_PROJECT_ROOT_RESOLVED)
+    except ValueError:
         print(f"✗ 图片必须位于项目目录内: {image_path}")
         return None
 
-    safe_name = "_".join(rel_path.with_suffix('').parts) + "_thumb.jpg"
-    thumbnail_path = THUMB_DIR / safe_name
+    return thumbnail_path_for(rel_path)
 
-    # 如果缩略图是最新的，跳过生成
-    if thumbnail_path.exists():
-        if thumbnail_path.stat().st_mtime >= image_path.stat().st_mtime:
-            return thumbnail_path
 
-    try:
-        with Image.open(image_path) as img:
-            width, height = img.size
-            # 只在需要时缩放
-            if width > max_width:
-                ratio = max_width / float(width)
-                new_height = max(int(height * ratio), 1)
-                img = img.resize((max_width, new_height), Image.LANCZOS)
+def is_thumbnail_fresh(image_path, thumbnail_path, thumb_mtimes=None, image_mtime=None):
+    """判断缩略图是否不旧于原图"""
+    # 批量刷新时传入 scandir 得到的修改时间，直接查表而不再逐个 stat
+    if thumb_mtimes is None:
+        if not thumbnail_path.exists():
+            return False
+        thumb_mtime = thumbnail_path.stat().st_mtime
+    else:
+        thumb_mtime = thumb_mtimes.get(thumbnail_path.name)
+        if thumb_mtime is None:
+            return False
+
+    if image_mtime is None:
+        image_mtime = image_path.stat().st_mtime
+    return thumb_mtime >= image_mtime
+
+
+def create_thumbnail(image_path, img, max_width=THUMB_MAX_WIDTH, quality=THUMB_QUALITY,
+                     thumbnail_path=None):
+    """为列表页生成小尺寸缩略图，img 为已打开的 image_path 图片（会被原地缩放）"""
+    global _THUMB_DIR_READY
+    if not _THUMB_DIR_READY:
+        THUMB_DIR.mkdir(parents=True, exist_ok=True)
+        _THUMB_DIR_READY = True
+
+    # 调用方传入 thumbnail_path 时，表示已确认缩略图需要重新生成
+    if thumbnail_path is None:
+        thumbnail_path = get_thumbnail_path(image_path)
+        if thumbnail_path is None:
+            return None
 
-            if img.mode not in ("RGB", "L"):
-                img = img.convert("RGB")
+        # 如果缩略图是最新的，跳过生成
+        if is_thumbnail_fresh(image_path, thumbnail_path):
+            return thumbnail_path
 
-            img.save(thumbnail_path, format="JPEG", quality=quality, optimize=True, progressive=True)
+    try:
+        # 让 libjpeg 以 1/2、1/4、1/8 比例直接解码；缩放只受宽度限制，
+        # 因此高度传 1，留出 2 倍余量给 Lanczos 做最终缩放。
+        # draft() 必须在像素被加载之前调用，之后调用不会生效
+        img.draft("RGB", (max_width * 2, 1))
+        # 高度给一个很大的值，按宽度等比缩放；原图较小时不做处理
+        img.thumbnail((max_width, 65536), Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        # 缩略图使用 WebP，同等画质下比 JPEG 小约三成
+        # 先编码到内存再一次性写入临时文件，最后原子替换，避免留下写了一半的缩略图
+        buf = io.BytesIO()
+        img.save(buf, format="WebP", quality=quality, method=THUMB_WEBP_METHOD)
+        # 临时文件名唯一，不同原图（如 a.jpg 与 a.png）并行写同一缩略图时互不干扰
+        fd, tmp_name = tempfile.mkstemp(dir=thumbnail_path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(buf.getvalue())
+            # mkstemp 创建的文件权限为 0600，改为普通文件权限以便站点读取
+            os.chmod(tmp_name, 0o644)
+            os.replace(tmp_name, thumbnail_path)
+        except BaseException:
+            # 写入或替换失败时删除临时文件，避免残留在发布的缩略图目录中
+            try:
+                os.unlink(tmp_name)
+            except FileNotFoundError:
+                pass
+            raise
 
         print(f"✓ 生成缩略图: {thumbnail_path.name}")
         return thumbnail_path
@@ -177,7 +271,7 @@ def create_collection_file(image_path, date_obj, location=None, tags=None, tease
     # 使用 header.teaser 格式以便在collection layout中正确显示
     front_matter = {
         'title': f"{base_name}",
-        'date': date_str,
+        'date': date_obj.date(),
         'header': {
             'teaser': teaser_path_str,
             'image': image_path_str
@@ -190,27 +284,21 @@ def create_collection_file(image_path, date_obj, location=None, tags=None, tease
     if tags:
         front_matter['tags'] = tags if isinstance(tags, list) else [tags]
     
-    # 写入文件
+    body = f"拍摄于 {date_str}"
+    if location:
+        body += f"，地点：{location}"
+    body += "。\n"
+
+    # 写入文件：front matter 交给 yaml 序列化，整份内容一次写入
     try:
+        content = (
+            "---\n"
+            + yaml.safe_dump(front_matter, sort_keys=False, allow_unicode=True)
+            + "---\n\n"
+            + body
+        )
         with open(collection_file, 'w', encoding='utf-8') as f:
-            f.write("---\n")
-            for key, value in front_matter.items():
-                if isinstance(value, dict):
-                    # 处理嵌套字典（如header）
-                    f.write(f"{key}:\n")
-                    for sub_key, sub_value in value.items():
-                        f.write(f"  {sub_key}: {sub_value}\n")
-                elif isinstance(value, list):
-                    f.write(f"{key}:\n")
-                    for item in value:
-                        f.write(f"  - {item}\n")
-                else:
-                    f.write(f"{key}: {value}\n")
-            f.write("---\n\n")
-            f.write(f"拍摄于 {date_str}")
-            if location:
-                f.write(f"，地点：{location}")
-            f.write("。\n")
+            f.write(content)
         
         print(f"✓ 创建collection文件: {collection_file.name}")
        
@@ -233,16 +321,25 @@ def process_single_image(image_path, tags=None, location=None):
         print(f"✗ {exc}")
         return image_path
     
-    # 读取EXIF数据
-    exif_data = get_exif_data(image_path)
-    
-    # 获取日期
-    date_obj = get_date_from_exif(exif_data)
-    
-    print("日期：",date_obj)
-    
-    # 创建collection文件
-    thumbnail_path = create_thumbnail(image_path)
+    # 每张图片只打开一次，EXIF读取和缩略图生成共用同一个句柄。
+    # 在 create_thumbnail 调用 draft() 之前不要访问 img.load()/像素数据，
+    # 否则会按原始分辨率完整解码，缩小解码就失效了
+    try:
+        with open_image(image_path) as img:
+            # 读取EXIF数据
+            exif_data = get_exif_data(img)
+            
+            # 获取日期
+            date_obj = get_date_from_exif(exif_data)
+            
+            print("日期：",date_obj)
+            
+            # 创建collection文件
+            thumbnail_path = create_thumbnail(image_path, img)
+    except Exception as exc:
+        print(f"✗ 打开图片失败 {image_path}: {exc}")
+        return image_path
+
     teaser_url = None
     if thumbnail_path:
         teaser_url = path_to_site_url(thumbnail_path)
@@ -252,6 +349,15 @@ def process_single_image(image_path, tags=None, location=None):
     return image_path
 
 
+def process_image_task(image_path, tags=None, location=None):
+    """在进程池中处理单张图片，单张失败只打印错误，不中断整批"""
+    try:
+        return process_single_image(image_path, tags, location)
+    except Exception as exc:
+        print(f"✗ 处理图片失败 {image_path}: {exc}")
+        return None
+
+
 def process_directory(source_dir=None, tags=None, location=None):
     """批量处理目录中的图片"""
     if source_dir is None:
@@ -263,13 +369,8 @@ def process_directory(source_dir=None, tags=None, location=None):
         print(f"目录不存在: {source_dir}")
         return
     
-    # 支持的图片格式
-    image_extensions = ['.jpg', '.jpeg', '.JPG', '.JPEG', '.png', '.PNG']
-    
     # 查找所有图片文件
-    image_files = []
-    for ext in image_extensions:
-        image_files.extend(source_dir.glob(f"*{ext}"))
+    image_files = [Path(entry.path) for entry in scan_image_entries(source_dir)]
     
     if not image_files:
         print(f"在 {source_dir} 中未找到图片文件")
@@ -277,30 +378,61 @@ def process_directory(source_dir=None, tags=None, location=None):
     
     print(f"找到 {len(image_files)} 张图片")
     
-    # 处理每张图片
-    for image_path in sorted(image_files):
-        process_single_image(image_path, tags, location)
+    # 提前创建缩略图目录，避免多个进程同时 mkdir
+    THUMB_DIR.mkdir(parents=True, exist_ok=True)
+
+    # 多进程并行处理每张图片（解码/缩放/编码均为CPU密集）
+    worker = functools.partial(process_image_task, tags=tags, location=location)
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(worker, sorted(image_files)))
     
     print(f"\n✓ 处理完成！共处理 {len(image_files)} 张图片")
 
 
+def refresh_thumbnail(image_path, thumbnail_path):
+    """打开单张原始照片并重新生成缩略图，单张失败只打印错误，不中断整批"""
+    try:
+        with open_image(image_path) as img:
+            return create_thumbnail(image_path, img, thumbnail_path=thumbnail_path)
+    except Exception as exc:
+        print(f"✗ 生成缩略图失败 {image_path}: {exc}")
+        return None
+
+
 def refresh_thumbnails():
     """为现有图片重新生成缩略图"""
     if not PHOTOS_DIR.exists():
         print(f"目录不存在: {PHOTOS_DIR}")
         return
 
-    originals = []
-    for pattern in ("*.jpg", "*.jpeg", "*.JPG", "*.JPEG", "*.png", "*.PNG"):
-        originals.extend([p for p in PHOTOS_DIR.glob(pattern) if p.parent == PHOTOS_DIR])
+    # 各扫描一次原图目录和缩略图目录，修改时间直接取自 scandir 结果
+    originals = sorted(scan_image_entries(PHOTOS_DIR), key=lambda entry: entry.name)
 
     if not originals:
         print("没有找到需要生成缩略图的原始照片。")
         return
 
     print(f"找到 {len(originals)} 张原始照片，正在生成缩略图...")
-    for photo in originals:
-        create_thumbnail(photo)
+    THUMB_DIR.mkdir(parents=True, exist_ok=True)
+    with os.scandir(THUMB_DIR) as entries:
+        thumb_mtimes = {entry.name: entry.stat().st_mtime for entry in entries}
+
+    # 原图目录只解析一次，缩略图名直接由文件名拼出，不再逐张 resolve()
+    photos_rel_dir = PHOTOS_DIR.resolve().relative_to(_PROJECT_ROOT_RESOLVED)
+
+    # 在主进程中查表判断新旧，只把需要重新生成的照片分发给子进程
+    stale_photos = []
+    stale_thumbs = []
+    for entry in originals:
+        photo = Path(entry.path)
+        thumbnail_path = thumbnail_path_for(photos_rel_dir / entry.name)
+        if not is_thumbnail_fresh(photo, thumbnail_path, thumb_mtimes, entry.stat().st_mtime):
+            stale_photos.append(photo)
+            stale_thumbs.append(thumbnail_path)
+
+    if stale_photos:
+        with ProcessPoolExecutor() as executor:
+            list(executor.map(refresh_thumbnail, stale_photos, stale_thumbs))
 
     print("✓ 缩略图更新完成！")
 
@@ -326,6 +458,12 @@ def main():
     # 确保目录存在
     COLLECTION_DIR.mkdir(exist_ok=True)
     PHOTOS_DIR.mkdir(parents=True, exist_ok=True)
+
+    # 原图解码依赖 libjpeg-turbo 的 SIMD 路径，缩略图编码需要 WebP 支持
+    if not features.check_feature("libjpeg_turbo"):
+        print("提示：当前 Pillow 未链接 libjpeg-turbo，读取照片会较慢")
+    if not features.check("webp"):
+        print("提示：当前 Pillow 不支持 WebP，将无法生成缩略图")
     
     if args.refresh_thumbs:
         refresh_thumbnails()